@@ -13,27 +13,253 @@ import shutil
 import subprocess
 import sys
 import os
+import queue
+import re
+import signal
+import threading
 import time
+from contextlib import ExitStack
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Tuple
+
+try:  # 可选依赖：ISA-L 进程内 gzip 读写，省去 pigz 子进程与两次管道拷贝
+    from isal import igzip
+except ImportError:
+    igzip = None
 
 # ==========================================
 # 全局配置
 # ==========================================
 DEFAULT_OUTPUT_BASE = Path("/data/lulab_commonspace/guozehua/crispresso_out")
 
-# DNA 反向互补的高效翻译表
-TRANS_TABLE = str.maketrans("ATCGNabcde", "TAGCNtagcn")
+# 拼接时每次从解压管道读取的块大小 (128 KiB)
+STITCH_CHUNK_SIZE = 128 * 1024
+
+# 解压/压缩管道的内核缓冲区大小 (Linux 默认仅 64 KiB)
+STITCH_PIPE_SIZE = 1024 * 1024
+
+# 拼接结果先攒进输出缓冲区，满 1 MiB 再整块写入压缩管道
+STITCH_OUTPUT_FLUSH_SIZE = 1024 * 1024
+
+# 读/写线程与拼接主线程之间的队列深度 (块数)
+STITCH_QUEUE_DEPTH = 8
+
+# 样本名中需要剔除的字符 (保留字母、数字、'-'、'_')，供生成文件名使用
+SAFE_NAME_RE = re.compile(r"[^\w-]")
+
+# DNA 反向互补的高效翻译表 (bytes，直接作用于二进制管道数据)
+TRANS_TABLE = bytes.maketrans(b"ATCGNatcgn", b"TAGCNtagcn")
 
-def get_reverse_complement(seq: str) -> str:
-    """Returns the reverse complement of a DNA sequence using str.translate."""
+def get_reverse_complement(seq: bytes) -> bytes:
+    """Returns the reverse complement of a DNA sequence using bytes.translate."""
     return seq.translate(TRANS_TABLE)[::-1]
 
+def enlarge_pipe(pipe) -> None:
+    """Raises the kernel buffer of a pipe to STITCH_PIPE_SIZE (Linux only, best effort)."""
+    if not sys.platform.startswith("linux"):
+        return
+    import fcntl
+    try:
+        # F_SETPIPE_SZ 在 Python 3.10 之前未导出，其值为 1031
+        fcntl.fcntl(pipe.fileno(), getattr(fcntl, "F_SETPIPE_SZ", 1031), STITCH_PIPE_SIZE)
+    except OSError:
+        pass
+
+def check_helper_exit(proc: subprocess.Popen, path: Path, allow_sigpipe: bool = False) -> None:
+    """Raises if a gzip helper process exited with an error (call after it was waited on)."""
+    code = proc.returncode
+    # 另一侧先读完时会提前关闭这一侧的管道，解压进程因此死于 SIGPIPE，不算失败
+    if code == 0 or (allow_sigpipe and code == -signal.SIGPIPE):
+        return
+    raise RuntimeError(f"'{' '.join(proc.args)}' failed on {path} (exit status {code})")
+
+def open_gzip_input(path: Path, decompress_cmd: List[str] | None, stack: ExitStack):
+    """
+    Opens a gzipped FASTQ for binary reading. decompress_cmd=None means
+    in-process ISA-L decoding; otherwise the command's stdout pipe is used.
+    """
+    f_in = stack.enter_context(open(path, "rb"))
+    # 预读提示挂在打开的文件描述上，所以由本进程打开文件，再作为 stdin 交给解压程序
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f_in.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+    if decompress_cmd is None:
+        return stack.enter_context(igzip.open(f_in, "rb"))
+    proc = subprocess.Popen(decompress_cmd, stdin=f_in, stdout=subprocess.PIPE, bufsize=STITCH_CHUNK_SIZE)
+    # 回调先于 Popen 的 __exit__ 注册，ExitStack 倒序退出，检查时进程已被 wait
+    stack.callback(check_helper_exit, proc, path, allow_sigpipe=True)
+    stack.enter_context(proc)
+    enlarge_pipe(proc.stdout)
+    return proc.stdout
+
+def open_gzip_output(path: Path, compress_cmd: List[str] | None, stack: ExitStack):
+    """Opens a gzip output for binary writing; compress_cmd=None means in-process ISA-L."""
+    if compress_cmd is None:
+        return stack.enter_context(igzip.open(path, "wb", compresslevel=1))
+    f_out_raw = stack.enter_context(open(path, "wb"))
+    # 写端保持默认缓冲：写线程每次交付 ~1 MiB 的整块，BufferedWriter 会直接透传，
+    # 不需要额外的大缓冲区
+    proc = subprocess.Popen(compress_cmd, stdin=subprocess.PIPE, stdout=f_out_raw)
+    stack.callback(check_helper_exit, proc, path)
+    stack.enter_context(proc)
+    enlarge_pipe(proc.stdin)
+    return proc.stdin
+
+def iter_fastq_record_lines(stream, chunk_size: int = STITCH_CHUNK_SIZE) -> Iterator[List[bytes]]:
+    """
+    Reads a binary FASTQ stream in chunks of up to chunk_size bytes and
+    yields lists of lines that always hold whole records (len % 4 == 0).
+    """
+    pending: List[bytes] = []
+    tail = b""
+    # read1() 最多只做一次底层 read，管道里有多少就先处理多少，不必等凑满整块
+    read_chunk = getattr(stream, "read1", stream.read)
+    while True:
+        chunk = read_chunk(chunk_size)
+        if not chunk:
+            break
+        if b"\r" in chunk:
+            chunk = chunk.replace(b"\r", b"")
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        pending += lines
+        n_lines = len(pending) - len(pending) % 4
+        if n_lines:
+            yield pending[:n_lines]
+            del pending[:n_lines]
+
+    if tail:
+        pending.append(tail)
+    if pending:
+        # 截断的最后一条记录：补齐缺失行，与逐行读取时的行为一致
+        pending += [b""] * (-len(pending) % 4)
+        yield pending
+
+
+def iter_prefetched(iterable, depth: int = STITCH_QUEUE_DEPTH) -> Iterator:
+    """
+    Runs iterable in a background thread and yields its items through a
+    bounded queue, so blocking pipe reads overlap with the consumer's work.
+    """
+    items: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors: List[BaseException] = []
+    done = object()
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                items.put(item)
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            errors.append(e)
+        items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        # 消费方提前退出时清空队列，让阻塞在 put 上的读线程得以看到 stop 并结束
+        stop.set()
+        while True:
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                break
+
+
+def write_blocks(stream, blocks: queue.Queue, errors: List[BaseException]) -> None:
+    """
+    Writer-thread loop: writes blocks from the queue until a None sentinel.
+    After a write error it keeps draining so the producer never blocks.
+    """
+    while True:
+        block = blocks.get()
+        if block is None:
+            return
+        if errors:
+            continue
+        try:
+            stream.write(block)
+        except BaseException as e:
+            errors.append(e)
+
+
+def iter_paired_record_lines(
+    stream1, stream2, chunk_size: int = STITCH_CHUNK_SIZE
+) -> Iterator[Tuple[List[bytes], List[bytes]]]:
+    """Yields (R1 lines, R2 lines) batches holding the same number of records."""
+    # R1、R2 各由一个读线程预取，管道读取时释放 GIL，可与主线程的拼接重叠
+    it1 = iter_prefetched(iter_fastq_record_lines(stream1, chunk_size))
+    it2 = iter_prefetched(iter_fastq_record_lines(stream2, chunk_size))
+    buf1: List[bytes] = []
+    buf2: List[bytes] = []
+    r2_exhausted = False
+    try:
+        while True:
+            # 总是从记录较少的一侧补充，保证两侧批次对齐
+            if r2_exhausted or len(buf1) <= len(buf2):
+                lines = next(it1, None)
+                if lines is None:
+                    break
+                buf1 += lines
+            else:
+                lines = next(it2, None)
+                if lines is None:
+                    print("\n[Warning] R2 has fewer reads than R1; extra R1 reads are written with an empty R2.")
+                    r2_exhausted = True
+                else:
+                    buf2 += lines
+            if r2_exhausted:
+                # 与逐行读取时一致：R2 读完后其余 R1 照常输出，R2 部分留空
+                buf2 += [b""] * (len(buf1) - len(buf2))
+
+            n_lines = min(len(buf1), len(buf2))
+            if n_lines:
+                yield buf1[:n_lines], buf2[:n_lines]
+                del buf1[:n_lines]
+                del buf2[:n_lines]
+    finally:
+        it1.close()
+        it2.close()
+
+
+def stitch_record_batch(
+    lines1: List[bytes], lines2: List[bytes], pad_seq: bytes, pad_qual: bytes
+) -> bytes:
+    """Stitches a batch of paired records into one FASTQ text block."""
+    # 整批 R2 序列拼成一个块，只做一次 translate 和一次反转；
+    # 反转后各条序列的顺序也被倒置，split 之后再翻转列表即可还原
+    r2_seqs_rc = b"\n".join(lines2[1::4]).translate(TRANS_TABLE)[::-1].split(b"\n")
+    r2_seqs_rc.reverse()
+    # 质量值同理：整块反转一次，不做互补
+    r2_quals_rev = b"\n".join(lines2[3::4])[::-1].split(b"\n")
+    r2_quals_rev.reverse()
+    # 每条记录固定 10 个片段：先按模板铺好换行与填充，再用切片赋值一次性填入各列，
+    # 最后交给 C 层的 bytes.join，避免逐条记录的格式化
+    out = [b"", b"\n", b"", pad_seq, b"", b"\n+\n", b"", pad_qual, b"", b"\n"] * len(r2_seqs_rc)
+    out[0::10] = lines1[0::4]
+    out[2::10] = lines1[1::4]
+    out[4::10] = r2_seqs_rc
+    out[6::10] = lines1[3::4]
+    out[8::10] = r2_quals_rev
+    return b"".join(out)
+
+
 def stitch_paired_end_reads_stream(
     r1_path: Path, r2_path: Path, output_path: Path, n_padding: int
 ) -> None:
     """
-    Stitches R1 and R2 reads using system gzip piping.
+    Stitches R1 and R2 reads using system gzip piping (or in-process ISA-L).
     Format: R1 + (N * n_padding) + RC(R2)
     """
     print(f"[Process] Stitching reads...")
@@ -41,51 +267,74 @@ def stitch_paired_end_reads_stream(
     print(f"         Source R2: {r2_path}")
     print(f"         Target:    {output_path}")
     
-    pad_seq = "N" * n_padding
-    pad_qual = "!" * n_padding 
+    pad_seq = b"N" * n_padding
+    pad_qual = b"!" * n_padding
     
-    if shutil.which("pigz"):
+    # 解压优先级: rapidgzip (多线程) > ISA-L 进程内 > pigz > gunzip
+    # pigz 解压实际是单线程的；rapidgzip 可多线程解压任意 gzip。
+    # R1、R2 同时解压，各分一半核心 (-P)
+    decompress_cmd: List[str] | None
+    if shutil.which("rapidgzip"):
+        decompress_threads = max(1, (os.cpu_count() or 2) // 2)
+        decompress_cmd = ["rapidgzip", "-d", "-c", "-P", str(decompress_threads)]
+    elif igzip is not None:
+        decompress_cmd = None
+    elif shutil.which("pigz"):
         decompress_cmd = ["pigz", "-dc"]
-        compress_cmd = ["pigz", "-c"]
     else:
         decompress_cmd = ["gunzip", "-c"]
-        compress_cmd = ["gzip", "-c"]
 
-    cmd_r1 = decompress_cmd + [str(r1_path)]
-    cmd_r2 = decompress_cmd + [str(r2_path)]
+    # 压缩优先级: bgzip (多线程 bgzf) > pigz (多线程) > ISA-L 进程内 > gzip
+    # 拼接结果只是交给 CRISPResso 读一遍的中间文件，统一用最快的压缩级别
+    # bgzip 输出分块的 bgzf，与 gzip 兼容 (仍用 .fastq.gz 后缀)，下游可并行解压
+    compress_cmd: List[str] | None
+    if shutil.which("bgzip"):
+        compress_cmd = ["bgzip", "-@", str(os.cpu_count() or 1), "-l", "1", "-c"]
+    elif shutil.which("pigz"):
+        compress_cmd = ["pigz", "-1", "-c"]
+    elif igzip is not None:
+        compress_cmd = None
+    else:
+        compress_cmd = ["gzip", "-1", "-c"]
     
     try:
-        with subprocess.Popen(cmd_r1, stdout=subprocess.PIPE, text=True, bufsize=1024*1024) as p1, \
-             subprocess.Popen(cmd_r2, stdout=subprocess.PIPE, text=True, bufsize=1024*1024) as p2, \
-             open(output_path, "wb") as f_out_raw:
-             
-            with subprocess.Popen(compress_cmd, stdin=subprocess.PIPE, stdout=f_out_raw, text=True, bufsize=1024*1024) as p_out:
-                f1_stream, f2_stream, fout_stream = p1.stdout, p2.stdout, p_out.stdin
+        with ExitStack() as stack:
+            # 读端 Python 缓冲与 pigz/cat 的 128 KiB 读写粒度对齐；内核管道缓冲另行调大
+            in1 = open_gzip_input(r1_path, decompress_cmd, stack)
+            in2 = open_gzip_input(r2_path, decompress_cmd, stack)
+            fout_stream = open_gzip_output(output_path, compress_cmd, stack)
+
+            # 写线程负责把拼好的块送进压缩端，主线程只做解析与拼接
+            blocks: queue.Queue = queue.Queue(maxsize=STITCH_QUEUE_DEPTH)
+            write_errors: List[BaseException] = []
+            writer = threading.Thread(
+                target=write_blocks, args=(fout_stream, blocks, write_errors), daemon=True
+            )
+            writer.start()
+            try:
+                out_buf = bytearray()
                 count = 0
-                while True:
-                    r1_id = f1_stream.readline()
-                    r2_id = f2_stream.readline()
-                    if not r1_id: break 
-                    
-                    r1_seq = f1_stream.readline().strip()
-                    r2_seq = f2_stream.readline().strip()
-                    
-                    f1_stream.readline() 
-                    f2_stream.readline()
-                    
-                    r1_qual = f1_stream.readline().strip()
-                    r2_qual = f2_stream.readline().strip()
-                    
-                    r2_seq_rc = r2_seq.translate(TRANS_TABLE)[::-1]
-                    r2_qual_rev = r2_qual[::-1]
-                    
-                    merged_seq = r1_seq + pad_seq + r2_seq_rc
-                    merged_qual = r1_qual + pad_qual + r2_qual_rev
-                    
-                    fout_stream.write(f"{r1_id.strip()}\n{merged_seq}\n+\n{merged_qual}\n")
-                    count += 1
-                    if count % 100000 == 0:
-                        print(f"         Processed {count} reads...", end='\r')
+                next_report = 100000
+                # 按 128 KiB 块批量解析与拼接，避免逐行 readline 的解释器开销
+                for lines1, lines2 in iter_paired_record_lines(in1, in2):
+                    out_buf += stitch_record_batch(lines1, lines2, pad_seq, pad_qual)
+                    count += len(lines1) // 4
+                    if len(out_buf) >= STITCH_OUTPUT_FLUSH_SIZE:
+                        blocks.put(out_buf)
+                        out_buf = bytearray()
+                        if write_errors:
+                            break
+                        # 进度只在整块交付时检查，每 1 MiB 输出最多一次
+                        if count >= next_report:
+                            print(f"         Processed {count} reads...", end='\r')
+                            next_report = (count // 100000 + 1) * 100000
+                if out_buf:
+                    blocks.put(out_buf)
+            finally:
+                blocks.put(None)
+                writer.join()
+            if write_errors:
+                raise write_errors[0]
 
         print(f"\n[Success] Stitched {count} reads total.")
 
@@ -124,8 +373,7 @@ def build_command(
         stitch_dir.mkdir(parents=True, exist_ok=True)
         
         timestamp = time.strftime("%H%M%S")
-        safe_name = sample_name if sample_name else "sample"
-        safe_name = "".join([c for c in safe_name if c.isalnum() or c in ('-', '_')])
+        safe_name = SAFE_NAME_RE.sub("", sample_name or "sample")
         
         stitched_filename = f"{safe_name}_stitched_pad{n_padding}_{timestamp}.fastq.gz"
         stitched_file = stitch_dir / stitched_filename
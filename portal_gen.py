@@ -7,13 +7,33 @@ Features:
 3. Auto-detects report HTML files.
 """
 import os
-import datetime
+import re
+import string
+import html
+import threading
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from pathlib import Path
 
 # 定义硬编码的输出根目录 (必须与 analyze_crispresso.py 一致)
 ROOT_DIR = Path("/data/lulab_commonspace/guozehua/crispresso_out")
+ROOT_STR = str(ROOT_DIR)
 HTML_FILE = ROOT_DIR / "index.html"
+# 日志状态缓存：日志的 mtime/size 未变时直接复用上次的判断结果
+STATUS_CACHE_FILE = ROOT_DIR / ".portal_status_cache.json"
+# 并发探测各任务日志/报告的线程数 (纯 I/O，NFS 上延迟为主)
+PROBE_WORKERS = 16
 
+# 判断任务状态时读取的日志尾部长度
+LOG_TAIL_SIZE = 4096
+
+# 日志尾部的状态标记，直接在 bytes 上匹配，无需解码
+DONE_MARK = b"[Status] Job Completed Successfully"
+ERROR_RE = re.compile(rb"Error|Exception|Traceback")
+
+# 页面模板使用 string.Template 的 $占位符，CSS/JS 中的花括号无需转义
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="zh-CN">
@@ -21,29 +41,29 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <title>CRISPResso 任务监控门户</title>
     <style>
-        body {{ font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; margin: 20px; background-color: #f4f6f9; }}
-        h1 {{ color: #333; }}
-        h2 {{ margin-top: 0; }}
-        .card {{ background: white; padding: 20px; border-radius: 8px; box-shadow: 0 2px 4px rgba(0,0,0,0.1); margin-bottom: 30px; }}
+        body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; margin: 20px; background-color: #f4f6f9; }
+        h1 { color: #333; }
+        h2 { margin-top: 0; }
+        .card { background: white; padding: 20px; border-radius: 8px; box-shadow: 0 2px 4px rgba(0,0,0,0.1); margin-bottom: 30px; }
         
-        table {{ width: 100%; border-collapse: collapse; margin-top: 10px; table-layout: fixed; }}
-        th, td {{ text-align: left; padding: 12px; border-bottom: 1px solid #ddd; word-wrap: break-word; }}
-        th {{ background-color: #f8f9fa; color: #333; font-weight: 600; border-top: 2px solid #ddd; }}
-        tr:hover {{ background-color: #f1f1f1; }}
+        table { width: 100%; border-collapse: collapse; margin-top: 10px; table-layout: fixed; }
+        th, td { text-align: left; padding: 12px; border-bottom: 1px solid #ddd; word-wrap: break-word; }
+        th { background-color: #f8f9fa; color: #333; font-weight: 600; border-top: 2px solid #ddd; }
+        tr:hover { background-color: #f1f1f1; }
         
         /* 状态颜色 */
-        .status-running {{ color: #e67e22; font-weight: bold; }}
-        .status-done {{ color: #27ae60; font-weight: bold; }}
-        .status-error {{ color: #c0392b; font-weight: bold; }}
+        .status-running { color: #e67e22; font-weight: bold; }
+        .status-done { color: #27ae60; font-weight: bold; }
+        .status-error { color: #c0392b; font-weight: bold; }
         
-        a {{ text-decoration: none; color: #007bff; }}
-        a:hover {{ text-decoration: underline; }}
+        a { text-decoration: none; color: #007bff; }
+        a:hover { text-decoration: underline; }
         
-        .refresh-btn {{ position: absolute; top: 20px; right: 20px; padding: 10px 20px; background: #007bff; color: white; border: none; border-radius: 4px; cursor: pointer; }}
-        .path-info {{ font-size: 0.85em; color: #666; font-family: monospace; display: block; margin-top: 4px; }}
+        .refresh-btn { position: absolute; top: 20px; right: 20px; padding: 10px 20px; background: #007bff; color: white; border: none; border-radius: 4px; cursor: pointer; }
+        .path-info { font-size: 0.85em; color: #666; font-family: monospace; display: block; margin-top: 4px; }
         
         /* 清理命令样式 */
-        .cmd-code {{
+        .cmd-code {
             background: #fff0f0;
             border: 1px solid #ffcccc;
             color: #d63031;
@@ -54,17 +74,17 @@ HTML_TEMPLATE = """
             cursor: pointer;
             display: inline-block;
             user-select: all; /* 点击即可全选 */
-        }}
-        .cmd-code:hover {{ background: #ffe6e6; }}
-        .cmd-hint {{ font-size: 0.8em; color: #999; margin-left: 5px; }}
+        }
+        .cmd-code:hover { background: #ffe6e6; }
+        .cmd-hint { font-size: 0.8em; color: #999; margin-left: 5px; }
         
         /* 分区标题颜色 */
-        .header-success {{ border-left: 5px solid #27ae60; padding-left: 10px; color: #2c3e50; }}
-        .header-error {{ border-left: 5px solid #c0392b; padding-left: 10px; color: #c0392b; }}
+        .header-success { border-left: 5px solid #27ae60; padding-left: 10px; color: #2c3e50; }
+        .header-error { border-left: 5px solid #c0392b; padding-left: 10px; color: #c0392b; }
     </style>
     <script>
         // 每60秒自动刷新一次
-        setTimeout(function(){{ location.reload(); }}, 60000);
+        setTimeout(function(){ location.reload(); }, 60000);
     </script>
 </head>
 <body>
@@ -72,22 +92,23 @@ HTML_TEMPLATE = """
     
     <div style="margin-bottom: 20px;">
         <h1>🧬 CRISPResso 任务看板</h1>
-        <p style="color: #666;">数据根目录: <code>{root_dir}</code> | 更新时间: {update_time}</p>
+        <p style="color: #666;">数据根目录: <code>$root_dir</code> | 更新时间: $update_time</p>
     </div>
 
     <div class="card">
         <h2 class="header-success">🚀 进行中 & 已完成 (Active Tasks)</h2>
-        {table_active}
+        $table_active
     </div>
 
     <div class="card">
         <h2 class="header-error">❌ 异常 & 失败记录 (Failed / Errors)</h2>
         <p>💡 提示：点击红色的清理命令可直接全选，复制到服务器终端运行即可删除该记录。</p>
-        {table_failed}
+        $table_failed
     </div>
 </body>
 </html>
 """
+HTML_PAGE = string.Template(HTML_TEMPLATE)
 
 TABLE_HEADER_TEMPLATE = """
 <table>
@@ -106,151 +127,263 @@ TABLE_HEADER_TEMPLATE = """
 </table>
 """
 
-def analyze_job_status(log_file: Path):
+# 表格模板在导入时按 {占位符} 切成 4 段静态片段，生成时直接 join
+TABLE_FRAGMENTS = tuple(re.split(r"\{\w+\}", TABLE_HEADER_TEMPLATE))
+
+def generate_table_html(result_col_width, result_col_name, rows):
+    t0, t1, t2, t3 = TABLE_FRAGMENTS
+    return "".join((t0, result_col_width, t1, result_col_name, t2, rows, t3))
+
+def read_log_tail(fd: int, size: int, n: int = LOG_TAIL_SIZE) -> bytes:
+    """用 os.pread 读取已打开文件末尾 n 字节，不经过 Python 文件对象与缓冲层"""
+    return os.pread(fd, min(n, size), max(0, size - n))
+
+def classify_log_tail(last_content: bytes):
+    """根据日志尾部内容判断状态，返回 (Status_Category, HTML_String)"""
+    if DONE_MARK in last_content:
+        return 'DONE', '<span class="status-done">已完成 ✅</span>'
+    elif ERROR_RE.search(last_content):
+        return 'ERROR', '<span class="status-error">报错 ❌</span>'
+    else:
+        return 'RUNNING', '<span class="status-running">运行中 ⏳</span>'
+
+def temp_path_for(target: Path) -> Path:
+    """原子替换用的临时文件名；带上进程/线程号，避免并发生成门户时互相覆盖"""
+    return target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+def discard_temp(tmp_file: Path):
+    """写入失败时删除残留的临时文件，避免在门户目录中越积越多"""
+    try:
+        os.unlink(tmp_file)
+    except OSError:
+        pass
+
+def load_status_cache():
     """
-    分析任务状态。
-    返回: (Status_Category, HTML_String)
-    Category: 'DONE', 'RUNNING', 'ERROR'
+    读取上次刷新留下的状态缓存:
+    {log_path: [mtime_ns, size, category, html], job_dir: [mtime_ns, report_path]}
     """
-    if not log_file.exists():
-        return 'ERROR', '<span class="status-error">无日志 (启动失败?)</span>'
-    
     try:
-        # 读取日志最后几行
-        with open(log_file, 'rb') as f:
-            try:  # Seek to end
-                f.seek(-4096, 2) 
-            except OSError: # File too small
-                f.seek(0)
-            last_content = f.read().decode('utf-8', errors='ignore')
-            
-        if "[Status] Job Completed Successfully" in last_content:
-            return 'DONE', '<span class="status-done">已完成 ✅</span>'
-        elif "Error" in last_content or "Exception" in last_content or "Traceback" in last_content:
-            return 'ERROR', '<span class="status-error">报错 ❌</span>'
-        else:
-            return 'RUNNING', '<span class="status-running">运行中 ⏳</span>'
-    except Exception:
+        with open(STATUS_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def save_status_cache(cache):
+    """原子写回状态缓存 (先写临时文件再 rename)"""
+    tmp_file = temp_path_for(STATUS_CACHE_FILE)
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_file, STATUS_CACHE_FILE)
+    except OSError as e:
+        discard_temp(tmp_file)
+        print(f"Warning: failed to save status cache: {e}")
+
+def cached_job_status(log_file: Path, old_cache, new_cache):
+    """
+    带缓存地分析任务状态：以 (mtime, size) 判断日志是否变化。
+    本次用到的条目写入 new_cache，已删除任务的条目随之淘汰。
+    命中缓存时每个任务只需一次 stat (不存在即 ENOENT)，未命中才 open 读取尾部。
+    """
+    try:
+        st = os.stat(log_file)
+    except FileNotFoundError:
+        return 'ERROR', '<span class="status-error">无日志 (启动失败?)</span>'
+    except OSError:
         return 'ERROR', '<span class="status-error">读取异常 ❓</span>'
 
+    key = str(log_file)
+    entry = old_cache.get(key)
+    if isinstance(entry, list) and len(entry) == 4 and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+        status_cat, status_html = entry[2], entry[3]
+    else:
+        try:
+            fd = os.open(log_file, os.O_RDONLY)
+            try:
+                # 读取日志最后几行
+                status_cat, status_html = classify_log_tail(read_log_tail(fd, st.st_size))
+            finally:
+                os.close(fd)
+        except Exception:
+            return 'ERROR', '<span class="status-error">读取异常 ❓</span>'
+
+    new_cache[key] = [st.st_mtime_ns, st.st_size, status_cat, status_html]
+    return status_cat, status_html
+
+def cached_report_html(job_dir: Path, old_cache, new_cache):
+    """
+    带缓存的 find_report_html：已完成任务的报告路径不再变化，
+    以任务目录的 mtime 作为失效依据，命中时免去整棵目录的遍历。
+    """
+    try:
+        mtime_ns = os.stat(job_dir).st_mtime_ns
+    except OSError:
+        return find_report_html(job_dir)
+
+    key = str(job_dir)
+    entry = old_cache.get(key)
+    if isinstance(entry, list) and len(entry) == 2 and entry[0] == mtime_ns:
+        report_file = Path(entry[1]) if entry[1] else None
+    else:
+        report_file = find_report_html(job_dir)
+    new_cache[key] = [mtime_ns, str(report_file) if report_file else None]
+    return report_file
+
+def iter_html_files(root):
+    """递归列出 root 下的 html 文件 (os.DirEntry)，用 scandir 自带的类型信息避免逐项 stat"""
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_html_files(entry.path)
+            elif entry.name.endswith(".html"):
+                yield entry
+
 def find_report_html(job_dir: Path):
     """智能搜索报告文件"""
-    # 策略: 搜索所有子目录中的 html 文件
+    # 策略: 搜索所有子目录中的 html 文件，命中 report 立即返回
+    best_candidate = None
     try:
-        html_candidates = list(job_dir.rglob("*.html"))
+        for entry in iter_html_files(job_dir):
+            name = entry.name.lower()
+            if entry.name == "index.html": continue
+            if "report" in name: return Path(entry.path)
+            if "crispresso_on" in name: best_candidate = Path(entry.path)
     except Exception:
         return None
-    
-    best_candidate = None
-    for html in html_candidates:
-        if html.name == "index.html": continue
-        if "report" in html.name.lower(): return html
-        if "crispresso_on" in html.name.lower(): best_candidate = html
             
     return best_candidate
 
-def generate_row_html(job, status_html, result_content):
-    return f"""
+# 行模板按插值位置切成静态片段，逐行用 "".join 拼接
+ROW_FRAGMENTS = (
+    """
         <tr>
-            <td><strong>{job['name']}</strong></td>
-            <td>{job['time']}</td>
-            <td>{status_html}</td>
-            <td><a href="./{job['name']}/CRISPResso_RUNNING_LOG.txt" target="_blank">查看日志</a></td>
-            <td>{result_content}</td>
+            <td><strong>""",
+    """</strong></td>
+            <td>""",
+    """</td>
+            <td>""",
+    """</td>
+            <td><a href="./""",
+    """/CRISPResso_RUNNING_LOG.txt" target="_blank">查看日志</a></td>
+            <td>""",
+    """</td>
         </tr>
-    """
+    """,
+)
+
+def generate_row_html(job, status_html, result_content):
+    r0, r1, r2, r3, r4, r5 = ROW_FRAGMENTS
+    return "".join((
+        r0, job['name_html'], r1, job['time'], r2, status_html, r3, job['name_html'], r4, result_content, r5
+    ))
 
 def generate_portal():
     if not ROOT_DIR.exists():
         print(f"Directory {ROOT_DIR} does not exist.")
         return
 
+    update_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+
     # 1. 扫描任务
     jobs = []
-    for item in ROOT_DIR.iterdir():
-        if item.is_dir() and item.name.startswith("Job_"):
-            try:
-                # 格式: Job_YYYYMMDD_HHMMSS_SampleName
-                sort_key = item.name 
-                parts = item.name.split('_')
-                display_time = f"{parts[1][:4]}-{parts[1][4:6]}-{parts[1][6:]} {parts[2][:2]}:{parts[2][2:]}"
-            except:
-                sort_key = item.name
+    # os.scandir 的 DirEntry 自带 readdir 返回的类型信息，先按名字前缀过滤再判断目录，省去逐项 stat
+    with os.scandir(ROOT_DIR) as it:
+        for entry in it:
+            if not (entry.name.startswith("Job_") and entry.is_dir()):
+                continue
+            # 格式: Job_YYYYMMDD_HHMMSS_SampleName，定宽字段直接切片
+            n = entry.name
+            if len(n) >= 19 and n[12] == '_':
+                display_time = f"{n[4:8]}-{n[8:10]}-{n[10:12]} {n[13:15]}:{n[15:17]}"
+            else:
                 display_time = "Unknown"
             
             jobs.append({
-                "path": item,
-                "name": item.name,
+                "path": Path(entry.path),
+                "name": entry.name,
+                # 任务名在每行中出现多次，转义一次复用
+                "name_html": html.escape(entry.name, quote=True),
                 "time": display_time,
-                "sort": sort_key
             })
     
     # 按时间倒序
-    jobs.sort(key=lambda x: x['sort'], reverse=True)
+    jobs.sort(key=itemgetter('name'), reverse=True)
 
-    rows_active = ""
-    rows_failed = ""
-    
-    count_active = 0
-    count_failed = 0
+    rows_active = []
+    rows_failed = []
+
+    status_cache = load_status_cache()
+    new_status_cache = {}
+
+    def probe_job(job):
+        """读日志状态并查找报告，均为 I/O，交给线程池并发执行"""
+        log_file = job['path'] / "CRISPResso_RUNNING_LOG.txt"
+        status_cat, status_html = cached_job_status(log_file, status_cache, new_status_cache)
+        # 报告在任务完成后才会生成，运行中的任务不必遍历目录
+        if status_cat == 'DONE':
+            report_file = cached_report_html(job['path'], status_cache, new_status_cache)
+        else:
+            report_file = None
+        return status_cat, status_html, report_file
+
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+        probes = list(executor.map(probe_job, jobs))
 
     # 2. 分类处理
-    for job in jobs:
+    for job, (status_cat, status_html, report_file) in zip(jobs, probes):
         job_dir = job['path']
-        log_file = job_dir / "CRISPResso_RUNNING_LOG.txt"
-        
-        status_cat, status_html = analyze_job_status(log_file)
         
         # === 成功/进行中 组 ===
         if status_cat in ['DONE', 'RUNNING']:
-            report_file = find_report_html(job_dir)
             if report_file:
-                rel_path = report_file.relative_to(ROOT_DIR)
-                result_content = f'<a href="./{rel_path}" target="_blank">📄 查看报告 ({report_file.name})</a>'
+                rel_path = html.escape(str(report_file.relative_to(ROOT_DIR)), quote=True)
+                result_content = f'<a href="./{rel_path}" target="_blank">📄 查看报告 ({html.escape(report_file.name)})</a>'
                 result_content += f'<div class="path-info">{rel_path}</div>'
             else:
                 result_content = '<span style="color:#999">等待生成...</span>'
             
-            rows_active += generate_row_html(job, status_html, result_content)
-            count_active += 1
+            rows_active.append(generate_row_html(job, status_html, result_content))
             
         # === 失败/错误 组 ===
         else:
             # 生成清理命令
-            clean_cmd = f"rm -rf {job_dir}"
+            clean_cmd = html.escape(f"rm -rf {job_dir}")
             result_content = f'<code class="cmd-code" title="点击全选，复制去终端运行">{clean_cmd}</code>'
             
-            rows_failed += generate_row_html(job, status_html, result_content)
-            count_failed += 1
+            rows_failed.append(generate_row_html(job, status_html, result_content))
+
+    save_status_cache(new_status_cache)
 
     # 3. 组装表格
-    if count_active > 0:
-        table_active = TABLE_HEADER_TEMPLATE.format(
-            result_col_width="45%", result_col_name="结果报告", rows=rows_active
-        )
+    if rows_active:
+        table_active = generate_table_html("45%", "结果报告", "".join(rows_active))
     else:
         table_active = "<p style='padding:20px; color:#666;'>暂无活跃任务。</p>"
 
-    if count_failed > 0:
-        table_failed = TABLE_HEADER_TEMPLATE.format(
-            result_col_width="45%", result_col_name="清理命令 (Server)", rows=rows_failed
-        )
+    if rows_failed:
+        table_failed = generate_table_html("45%", "清理命令 (Server)", "".join(rows_failed))
     else:
         table_failed = "<p style='padding:20px; color:#27ae60;'>暂无失败记录，太棒了！</p>"
 
     # 4. 生成最终HTML
-    final_html = HTML_TEMPLATE.format(
-        root_dir=ROOT_DIR,
-        update_time=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    final_html = HTML_PAGE.substitute(
+        root_dir=ROOT_STR,
+        update_time=update_time,
         table_active=table_active,
         table_failed=table_failed
     )
 
+    # 先完整写入临时文件再原子替换，HTTP 服务端不会读到写了一半的页面
+    tmp_file = temp_path_for(HTML_FILE)
     try:
-        with open(HTML_FILE, 'w') as f:
-            f.write(final_html)
+        with open(tmp_file, 'wb') as f:
+            f.write(final_html.encode('utf-8'))
+        os.replace(tmp_file, HTML_FILE)
         print(f"Portal updated at: {HTML_FILE}")
     except Exception as e:
+        discard_temp(tmp_file)
         print(f"Error writing portal file: {e}")
 
 if __name__ == "__main__":
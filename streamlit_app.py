@@ -1,18 +1,33 @@
 import subprocess
 import os
+import re
+import secrets
 import time
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import streamlit as st
+from portal_gen import generate_portal
 
 # ================= 配置区域 =================
 DEFAULT_OUTPUT_BASE = Path("/data/lulab_commonspace/guozehua/crispresso_out")
-CURRENT_SCRIPT_DIR = Path(__file__).parent.resolve()
+OUTPUT_BASE_STR = str(DEFAULT_OUTPUT_BASE)
+# 每次页面重跑都会执行这里；abspath 只做字符串拼接，不像 resolve 那样逐级 readlink
+CURRENT_SCRIPT_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 ANALYSIS_SCRIPT = CURRENT_SCRIPT_DIR / "analyze_crispresso.py"
-PORTAL_SCRIPT = CURRENT_SCRIPT_DIR / "portal_gen.py"
 
 # 硬编码的可执行文件路径
 CRISPRESSO_EXECUTABLE = "CRISPResso" 
+
+# 每个任务命令行中固定不变的前缀：当前解释器 + 分析脚本 + CRISPResso 可执行文件
+ANALYSIS_ARGV_PREFIX = (sys.executable, str(ANALYSIS_SCRIPT), "--executable", CRISPRESSO_EXECUTABLE)
+
+# 样本名中需要剔除的字符 (保留字母、数字、'-'、'_')，与 analyze_crispresso.py 一致
+SAFE_NAME_RE = re.compile(r"[^\w-]")
+
+# 两次门户生成之间的最短间隔 (秒)，连续提交时合并为一次
+PORTAL_MIN_INTERVAL = 10
 # ===========================================
 
 st.set_page_config(page_title="CRISPResso Async UI", layout="wide")
@@ -23,13 +38,17 @@ if 'last_job_info' not in st.session_state:
 st.title("CRISPResso 异步分析平台")
 
 PORTAL_PORT = "8505" 
-portal_url = f"http://{st.session_state.get('server_ip', '202.120.41.69')}:{PORTAL_PORT}"
 
-st.markdown(f"""
+# 页头内容在会话内不变，只在首次运行时拼接一次
+if 'header_md' not in st.session_state:
+    portal_url = f"http://{st.session_state.get('server_ip', '202.120.41.69')}:{PORTAL_PORT}"
+    st.session_state['header_md'] = f"""
 **模式**: 异步后台任务 (Fire-and-Forget)
 **数据中心**: `{DEFAULT_OUTPUT_BASE}`  
 **任务监控**: [点击打开任务监控门户 (Index.html)]({portal_url}) *(需确认 run.sh 中的端口配置)*
-""")
+"""
+
+st.markdown(st.session_state['header_md'])
 
 # ================= Sidebar =================
 with st.sidebar:
@@ -67,57 +86,116 @@ with col_right:
 
 # ================= 逻辑函数 =================
 
+@st.cache_resource(show_spinner=False)
+def ensure_output_base():
+    """每个进程只创建一次输出根目录；失败时抛出异常且不缓存，下次提交会重试"""
+    DEFAULT_OUTPUT_BASE.mkdir(parents=True, exist_ok=True)
+    return True
+
+@st.cache_resource(show_spinner=False)
+def portal_worker():
+    """
+    进程内唯一的门户生成线程 (脚本每次重跑都会重新执行，故用 cache_resource 保存)。
+    pending 记录最近一次提交的生成任务，用于去抖；last_run 为上次开始生成的时间，用于节流。
+    """
+    return {
+        "executor": ThreadPoolExecutor(max_workers=1), "pending": None,
+        "lock": threading.Lock(), "last_run": float("-inf"),
+    }
+
+def throttled_generate_portal(worker):
+    """距上次生成不足 PORTAL_MIN_INTERVAL 秒时先等到间隔结束再生成，新任务最多延迟一个间隔出现"""
+    delay = worker["last_run"] + PORTAL_MIN_INTERVAL - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    worker["last_run"] = time.monotonic()
+    generate_portal()
+
+def refresh_portal():
+    """在后台线程中重新生成门户页面，提交后立即返回"""
+    worker = portal_worker()
+    with worker["lock"]:
+        # 尚未开始的上一次生成已被本次覆盖，直接取消；
+        # 正在等待节流间隔的那次会在等待结束后扫描，同样能看到本次新建的任务
+        if worker["pending"] is not None:
+            worker["pending"].cancel()
+        worker["pending"] = worker["executor"].submit(throttled_generate_portal, worker)
+        return worker["pending"]
+
 def submit_job(sample_name, r1, r2, amp, guide, padding, min_len, min_qual, n_proc, plot_win, gap_open):
     timestamp = time.strftime("%Y%m%d_%H%M%S")
-    safe_name = "".join([c for c in sample_name if c.isalnum() or c in ('-', '_')])
-    job_folder_name = f"Job_{timestamp}_{safe_name}" 
-    job_dir = DEFAULT_OUTPUT_BASE / job_folder_name
+    safe_name = SAFE_NAME_RE.sub("", sample_name)
+    # 同一秒内的连续提交靠随机后缀区分，避免两个任务共用目录和日志
+    job_folder_name = f"Job_{timestamp}_{secrets.token_hex(3)}_{safe_name}" 
+    # 任务相关路径一次性拼成 str，后续的 mkdir/open/argv 直接使用，不再经过 pathlib
+    job_dir = os.path.join(OUTPUT_BASE_STR, job_folder_name)
     
     try:
-        job_dir.mkdir(parents=True, exist_ok=True)
+        ensure_output_base()
+        os.mkdir(job_dir)
     except Exception as e:
         return False, f"无法创建目录: {e}", None
 
-    log_file = job_dir / "CRISPResso_RUNNING_LOG.txt"
-
-    cmd_parts = [
-        "python", f'"{ANALYSIS_SCRIPT}"',
-        "--fastq_r1", f'"{r1}"',
-        "--amplicon", f'"{amp.strip()}"',
-        "--guide", f'"{guide.strip()}"',
-        "--output", f'"{job_dir}"',
-        "--name", f'"{safe_name}"',
-        "--executable", f'"{CRISPRESSO_EXECUTABLE}"'
-    ]
+    log_file = os.path.join(job_dir, "CRISPResso_RUNNING_LOG.txt")
+
+    cmd = list(ANALYSIS_ARGV_PREFIX)
+    cmd += (
+        "--fastq_r1", r1,
+        "--amplicon", amp.strip(),
+        "--guide", guide.strip(),
+        "--output", job_dir,
+        "--name", safe_name,
+    )
     
     # 基础参数
-    if r2: cmd_parts.extend(["--fastq_r2", f'"{r2}"'])
-    if padding > 0: cmd_parts.extend(["--n_padding", str(padding)])
-    if min_len > 0: cmd_parts.extend(["--min_read_length", str(min_len)])
-    if min_qual > 0: cmd_parts.extend(["--min_base_quality", str(min_qual)])
-    if n_proc > 0: cmd_parts.extend(["--n_processes", str(n_proc)])
+    if r2: cmd.extend(["--fastq_r2", r2])
+    if padding > 0: cmd.extend(["--n_padding", str(padding)])
+    if min_len > 0: cmd.extend(["--min_read_length", str(min_len)])
+    if min_qual > 0: cmd.extend(["--min_base_quality", str(min_qual)])
+    if n_proc > 0: cmd.extend(["--n_processes", str(n_proc)])
     
     # === 新增参数传递 ===
     # 注意：这里传递给 analyze_crispresso.py 的参数名必须与脚本里的 argparse 定义一致
-    cmd_parts.extend(["--plot_window_size", str(plot_win)])
-    cmd_parts.extend(["--needleman_wunsch_gap_open", str(gap_open)])
-
-    full_cmd_str = " ".join(cmd_parts)
-    nohup_cmd = f"nohup {full_cmd_str} > {log_file} 2>&1 & echo $!"
+    cmd.extend(["--plot_window_size", str(plot_win)])
+    cmd.extend(["--needleman_wunsch_gap_open", str(gap_open)])
 
     try:
-        process = subprocess.Popen(nohup_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process.communicate()
-        pid = stdout.strip().split('\n')[-1] if stdout else "Unknown"
+        # 直接以参数列表启动，无需 shell 转义；start_new_session 取代 nohup，
+        # 输出直接重定向到日志文件，PID 立即可得
+        log_fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            process = subprocess.Popen(
+                cmd, stdin=subprocess.DEVNULL, stdout=log_fd, stderr=subprocess.STDOUT,
+                start_new_session=True
+            )
+        finally:
+            os.close(log_fd)
+        # 任务是常驻 Streamlit 进程的直接子进程，不像 nohup ... & 那样交给 init 回收；
+        # 用守护线程 wait()，任务结束即被回收，不会残留僵尸进程
+        threading.Thread(target=process.wait, daemon=True).start()
+        pid = process.pid
+
+        # 记录 PID，之后可用 os.kill(pid, 0) 判断任务进程是否存活，无需查 ps；
+        # 结束的任务已由上面的 wait 线程回收，不会因僵尸进程被误判为存活
+        pid_file = os.path.join(job_dir, "pid.txt")
+        try:
+            pid_fd = os.open(pid_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(pid_fd, b"%d\n" % pid)
+            finally:
+                os.close(pid_fd)
+        except OSError:
+            pid_file = None
         
-        if PORTAL_SCRIPT.exists():
-            subprocess.Popen([sys.executable, str(PORTAL_SCRIPT)])
+        # 在本进程的后台线程里刷新门户，免去再启动一个解释器
+        refresh_portal()
         
         return True, pid, {
             "job_id": job_folder_name,
             "log": log_file,
             "dir": job_dir,
             "pid": pid,
+            "pid_file": pid_file,
             "name": safe_name
         }
     except Exception as e:
@@ -149,25 +227,37 @@ def name_submission_dialog():
                     
                     if success:
                         st.session_state['last_job_info'] = info
+                        st.session_state['last_job_md'] = None
                         st.rerun()
                     else:
                         st.error(f"提交失败: {msg}")
 
 # ================= Trigger Logic =================
-if st.session_state['last_job_info']:
+# 对话框本身即是 fragment，其中的交互只重跑对话框；
+# 上次任务信息面板同样放进 fragment，清除消息时不必重跑整个页面
+@st.fragment
+def last_job_panel():
     info = st.session_state['last_job_info']
+    if not info:
+        return
     st.success(f"✅ 任务 **{info['name']}** 已后台启动！ PID: **{info['pid']}**")
-    st.markdown(f"""
+    # 详情文本只在面板首次显示时拼接，之后的重跑直接复用
+    if not st.session_state.get('last_job_md'):
+        st.session_state['last_job_md'] = f"""
     - **日志文件**: `{info['log']}`
     - **输出目录**: `{info['dir']}`
     
     请访问 **Portal 门户页面** 查看进度。您可以继续提交下一个任务。
-    """)
+    """
+    st.markdown(st.session_state['last_job_md'])
     if st.button("开始新任务 (清除消息)"):
         st.session_state['last_job_info'] = None
-        st.rerun()
+        st.session_state['last_job_md'] = None
+        st.rerun(scope="fragment")
     st.divider()
 
+last_job_panel()
+
 run_clicked = st.button("🚀 准备提交任务", type="primary")
 
 if run_clicked:
@@ -176,11 +266,14 @@ if run_clicked:
     if not amplicon_seq: errors.append("请填写扩增子序列")
     if not guide_seq: errors.append("请填写 gRNA 序列")
     if n_padding > 0 and not fastq_r2_path: errors.append("拼接模式必须提供 R2")
-    if not ANALYSIS_SCRIPT.exists(): errors.append(f"找不到后台脚本: {ANALYSIS_SCRIPT}")
+    # 脚本存在的检查结果在会话内缓存，确认存在后不再 stat
+    if not st.session_state.get('analysis_script_ok'):
+        st.session_state['analysis_script_ok'] = ANALYSIS_SCRIPT.is_file()
+    if not st.session_state['analysis_script_ok']: errors.append(f"找不到后台脚本: {ANALYSIS_SCRIPT}")
 
     if errors:
-        for err in errors: st.error(f"❌ {err}")
+        st.error("\n\n".join(f"❌ {err}" for err in errors))
     else:
         name_submission_dialog()
 
-st.caption("Tasks are running in background via nohup.")
\ No newline at end of file
+st.caption("Tasks are running in background as detached processes.")
\ No newline at end of file